@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
-import difflib
+import concurrent.futures
+import numba
 import numpy as np
 import os
 import SimpleITK as sitk
+import scipy.ndimage
 import scipy.spatial
-from scipy.spatial.distance import directed_hausdorff
 
 
 labels = {
@@ -22,133 +23,311 @@ labels = {
           # 9: 'Infarction',
           # 10: 'Other',
           }
+LABEL_KEYS = tuple(labels.keys())
+
+# Let SimpleITK decode and filter the images on all cores
+sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(os.cpu_count())
 
 
 def evaluate_stats(test_idx):
 
-    for i in range(len(test_idx)):
-        test_filename = "../data/mrbrains/test/"+str(test_idx[i])+"/segm.nii.gz"
-        result_filename = "../results/result_"+str(test_idx[i])+".nii.gz"
-        test_file, result_file = getImages(test_filename,result_filename)
-        dsc = getDSC(test_file,result_file)
-        h95 = getHausdorff(test_file,result_file)
-        vs = getVS(test_file,result_file)
+    filenames = [("../data/mrbrains/test/"+str(idx)+"/segm.nii.gz", "../results/result_"+str(idx)+".nii.gz")
+                 for idx in test_idx]
+
+    # Read the next subject in the background while the metrics of the current one are computed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        next_images = reader.submit(getImages, *filenames[0]) if filenames else None
+
+        for i in range(len(filenames)):
+            test_array, result_array, test_file = next_images.result()
+            if i + 1 < len(filenames):
+                next_images = reader.submit(getImages, *filenames[i + 1])
+
+            # Share one confusion matrix between the overlap metrics
+            confusion = getConfusionMatrix(test_array, result_array)
+
+            # Extract the label boundaries once per image. Use the coordinate system of the test image for both
+            test_boundaries = getBoundaryCoordinates(test_array, test_file)
+            result_boundaries = getBoundaryCoordinates(result_array, test_file)
 
-        print('Dice', dsc, '(higher is better, max=1)')
-        print('HD', h95, 'mm', '(lower is better, min=0)')
-        print('VS', vs, '(higher is better, max=1)')
+            dsc = getDSC(confusion)
+            h95 = getHausdorff(test_boundaries, result_boundaries)
+            vs = getVS(confusion)
 
+            print('Dice', dsc, '(higher is better, max=1)')
+            print('HD', h95, 'mm', '(lower is better, min=0)')
+            print('VS', vs, '(higher is better, max=1)')
 
 
 def getImages(testFilename, resultFilename):
-    """Return the test and result images, thresholded and pathology masked."""
+    """Return the test and result label volumes as pathology masked uint8 arrays, and the test image.
+
+    The test image is only kept for its geometry (origin, spacing and direction).
+    """
     testImage = sitk.ReadImage(testFilename)
     resultImage = sitk.ReadImage(resultFilename)
 
     # Check for equality
     assert testImage.GetSize() == resultImage.GetSize()
 
-    # Get meta data from the test-image, needed for some sitk methods that check this
-    resultImage.CopyInformation(testImage)
+    testArray = sitk.GetArrayFromImage(testImage)
+    resultArray = sitk.GetArrayFromImage(resultImage)
 
     # Remove pathology from the test and result images, since we don't evaluate on that
-    pathologyImage = sitk.BinaryThreshold(testImage, 9, 11, 0, 1)  # pathology == 9 or 10
+    pathology = (testArray >= 9) & (testArray <= 11)  # pathology == 9 or 10
 
-    maskedTestImage = sitk.Mask(testImage, pathologyImage)  # tissue    == 1 --  8
-    maskedResultImage = sitk.Mask(resultImage, pathologyImage)
+    testArray[pathology] = 0  # tissue    == 1 --  8
+    resultArray[pathology] = 0
 
     # Force integer
-    if not 'integer' in maskedResultImage.GetPixelIDTypeAsString():
-        maskedResultImage = sitk.Cast(maskedResultImage, sitk.sitkUInt8)
+    return testArray.astype(np.uint8, copy=False), resultArray.astype(np.uint8, copy=False), testImage
+
+
+def getConfusionMatrix(testArray, resultArray, numLabels=11):
+    """Count voxels for every (test label, result label) pair in a single pass.
+
+    Row k sums to the test volume of label k, column k to the result volume and
+    the diagonal holds the per-label overlap. The matrix grows beyond numLabels x numLabels
+    if either volume contains a larger label, so no label is counted as another.
+    """
+    testArray = testArray.ravel().astype(np.intp)
+    resultArray = resultArray.ravel().astype(np.intp)
+    if testArray.size == 0:
+        return np.zeros((numLabels, numLabels), dtype=np.intp)
+
+    if min(testArray.min(), resultArray.min()) < 0:
+        raise ValueError("Label volumes must not contain negative labels")
+    numLabels = max(numLabels, int(max(testArray.max(), resultArray.max())) + 1)
 
-    return maskedTestImage, maskedResultImage
+    pairs = testArray * numLabels + resultArray
+    return np.bincount(pairs, minlength=numLabels * numLabels).reshape(numLabels, numLabels)
 
 
-def getDSC(testImage, resultImage):
+def getDSC(confusion):
     """Compute the Dice Similarity Coefficient."""
+    intersection = np.diagonal(confusion).tolist()
+    testSum = confusion.sum(axis=1).tolist()
+    resultSum = confusion.sum(axis=0).tolist()
+
     dsc = dict()
-    for k in labels.keys():
-        testArray = sitk.GetArrayFromImage(sitk.BinaryThreshold(testImage, k, k, 1, 0)).flatten()
-        resultArray = sitk.GetArrayFromImage(sitk.BinaryThreshold(resultImage, k, k, 1, 0)).flatten()
-
-        # similarity = 1.0 - dissimilarity
-        # scipy.spatial.distance.dice raises a ZeroDivisionError if both arrays contain only zeros.
-        try:
-            dsc[k] = 1.0 - scipy.spatial.distance.dice(testArray, resultArray)
-        except ZeroDivisionError:
+    for k in LABEL_KEYS:
+        # Dice is undefined if the label is absent from both images
+        denominator = testSum[k] + resultSum[k]
+        if denominator > 0:
+            dsc[k] = 2.0 * intersection[k] / denominator
+        else:
             dsc[k] = None
 
     return dsc
 
 
-def getHausdorff(testImage, resultImage):
-    """Compute the 95% Hausdorff distance."""
-    hd = dict()
-    for k in labels.keys():
-        lTestImage = sitk.BinaryThreshold(testImage, k, k, 1, 0)
-        lResultImage = sitk.BinaryThreshold(resultImage, k, k, 1, 0)
-
-        # Hausdorff distance is only defined when something is detected
-        statistics = sitk.StatisticsImageFilter()
-        statistics.Execute(lTestImage)
-        lTestSum = statistics.GetSum()
-        statistics.Execute(lResultImage)
-        lResultSum = statistics.GetSum()
-        if lTestSum == 0 or lResultSum == 0:
-            hd[k] = None
-            continue
-
-        # Edge detection is done by ORIGINAL - ERODED, keeping the outer boundaries of lesions. Erosion is performed in 2D
-        eTestImage = sitk.BinaryErode(lTestImage, (1, 1, 0))
-        eResultImage = sitk.BinaryErode(lResultImage, (1, 1, 0))
-
-        hTestImage = sitk.Subtract(lTestImage, eTestImage)
-        hResultImage = sitk.Subtract(lResultImage, eResultImage)
-
-        hTestArray = sitk.GetArrayFromImage(hTestImage)
-        hResultArray = sitk.GetArrayFromImage(hResultImage)
-
-        # Convert voxel location to world coordinates. Use the coordinate system of the test image
-        # np.nonzero   = elements of the boundary in numpy order (zyx)
-        # np.flipud    = elements in xyz order
-        # np.transpose = create tuples (x,y,z)
-        # testImage.TransformIndexToPhysicalPoint converts (xyz) to world coordinates (in mm)
-        # (Simple)ITK does not accept all Numpy arrays; therefore we need to convert the coordinate tuples into a Python list before passing them to TransformIndexToPhysicalPoint().
-        testCoordinates = [testImage.TransformIndexToPhysicalPoint(x.tolist()) for x in
-                           np.transpose(np.flipud(np.nonzero(hTestArray)))]
-        resultCoordinates = [resultImage.TransformIndexToPhysicalPoint(x.tolist()) for x in
-                             np.transpose(np.flipud(np.nonzero(hResultArray)))]
-
-        # Use a kd-tree for fast spatial search
-        def getDistancesFromAtoB(a, b):
-            kdTree = scipy.spatial.KDTree(a, leafsize=100)
-            return kdTree.query(b, k=1, eps=0, p=2)[0]
-
-        # Compute distances from test to result and vice versa.
-        dTestToResult = getDistancesFromAtoB(testCoordinates, resultCoordinates)
-        dResultToTest = getDistancesFromAtoB(resultCoordinates, testCoordinates)
-        hd[k] = max(np.percentile(dTestToResult, 95), np.percentile(dResultToTest, 95))
+def getPhysicalPoints(image, indices):
+    """Convert (N, 3) voxel indices in numpy order (zyx) to world coordinates (in mm)."""
+    # Reversing the columns gives (x,y,z) indices; index -> world is origin + direction * diag(spacing) * index,
+    # i.e. what TransformIndexToPhysicalPoint does per voxel
+    direction = np.array(image.GetDirection(), dtype=np.float64).reshape(3, 3)
+    spacing = np.array(image.GetSpacing(), dtype=np.float64)
+    origin = np.array(image.GetOrigin(), dtype=np.float64)
+
+    xyz = indices[:, ::-1].astype(np.float64)
+    return np.ascontiguousarray(xyz.dot((direction * spacing).T) + origin)
+
+
+def getBoundaries(labelArray):
+    """Return the zyx indices and labels of all voxels on the boundary of their label.
+
+    Equivalent to ORIGINAL - ERODED for every label at once: a voxel is on the boundary if any voxel
+    in its 3x3 in-plane neighbourhood has another label. Erosion is performed in 2D, and like
+    sitk.BinaryErode the image border does not count as background (mode='nearest').
+    """
+    minArray = scipy.ndimage.minimum_filter(labelArray, size=(1, 3, 3), mode='nearest')
+    maxArray = scipy.ndimage.maximum_filter(labelArray, size=(1, 3, 3), mode='nearest')
+    boundaryMask = (labelArray != minArray) | (labelArray != maxArray)
+
+    return np.argwhere(boundaryMask), labelArray[boundaryMask]
+
+
+@numba.njit('float32(float32[:, ::1], float32[:, ::1])', fastmath=True, cache=True, boundscheck=False, nogil=True)
+def hd_directed(A, B):
+    """Directed Hausdorff distance from the 3D points A to the 3D points B.
+
+    B is bucketed into a uniform grid and the nearest neighbour of every point of A is searched in
+    growing shells of cells around it (Taha & Hanbury). The search for a point stops as soon as it is
+    closer to B than the current maximum, since it can no longer raise the result, or when no
+    unvisited cell can hold a closer point. Squared distances are compared throughout.
+    """
+    nA, nB = A.shape[0], B.shape[0]
+
+    # Grid over the bounding box of B with about one point per cell
+    lo = np.empty(3, np.float32)
+    extent = np.empty(3, np.float32)
+    for d in range(3):
+        lo[d] = B[:, d].min()
+        extent[d] = B[:, d].max() - lo[d]
+    volume = extent[0] * extent[1] * extent[2]
+    if volume > 0:
+        h = (volume / nB) ** np.float32(1.0 / 3.0)
+    else:
+        h = extent.max() / nB
+    if h <= 0:
+        h = np.float32(1.0)
+    dims = np.empty(3, np.int64)
+    while True:
+        for d in range(3):
+            dims[d] = np.int64(extent[d] / h) + 1
+        if dims[0] * dims[1] * dims[2] <= 2 * nB + 8:
+            break
+        h *= np.float32(1.25)
+    nx, ny, nz = dims[0], dims[1], dims[2]
+
+    # Counting sort of B by cell: the points of cell c are sortedB[start[c]:start[c + 1]]
+    cellOfB = np.empty(nB, np.int64)
+    start = np.zeros(nx * ny * nz + 1, np.int64)
+    for j in range(nB):
+        bx = min(np.int64((B[j, 0] - lo[0]) / h), nx - 1)
+        by = min(np.int64((B[j, 1] - lo[1]) / h), ny - 1)
+        bz = min(np.int64((B[j, 2] - lo[2]) / h), nz - 1)
+        cellOfB[j] = (bx * ny + by) * nz + bz
+        start[cellOfB[j] + 1] += 1
+    for c in range(nx * ny * nz):
+        start[c + 1] += start[c]
+    fill = start[:-1].copy()
+    sortedB = np.empty((nB, 3), np.float32)
+    for j in range(nB):
+        sortedB[fill[cellOfB[j]]] = B[j]
+        fill[cellOfB[j]] += 1
+
+    cmax = np.float32(0.0)
+    for i in range(nA):
+        # Largest finite float32; fastmath assumes no infinities
+        cmin = np.float32(3.4028235e38)
+        ax, ay, az = A[i, 0], A[i, 1], A[i, 2]
+
+        # Cell of the query point, possibly outside the grid
+        cx = np.int64(np.floor((ax - lo[0]) / h))
+        cy = np.int64(np.floor((ay - lo[1]) / h))
+        cz = np.int64(np.floor((az - lo[2]) / h))
+        rmax = max(max(abs(cx), abs(nx - 1 - cx)), max(max(abs(cy), abs(ny - 1 - cy)), max(abs(cz), abs(nz - 1 - cz))))
+
+        # Shells closer than the Chebyshev distance from the query cell to the grid are empty; start there
+        done = False
+        r = max(max(max(0, -cx), cx - (nx - 1)), max(max(-cy, cy - (ny - 1)), max(-cz, cz - (nz - 1))))
+        while r <= rmax and not done:
+            # Visit the cells at Chebyshev distance r from (cx, cy, cz)
+            for x in range(max(cx - r, 0), min(cx + r, nx - 1) + 1):
+                onX = abs(x - cx) == r
+                for y in range(max(cy - r, 0), min(cy + r, ny - 1) + 1):
+                    if onX or abs(y - cy) == r:
+                        zStep = 1
+                    else:
+                        zStep = 2 * r
+                    for z in range(cz - r, cz + r + 1, zStep):
+                        if z < 0 or z >= nz:
+                            continue
+                        cell = (x * ny + y) * nz + z
+                        for j in range(start[cell], start[cell + 1]):
+                            dx = ax - sortedB[j, 0]
+                            dy = ay - sortedB[j, 1]
+                            dz = az - sortedB[j, 2]
+                            dist = dx * dx + dy * dy + dz * dz
+                            if dist < cmin:
+                                cmin = dist
+                        if cmin < cmax:
+                            done = True
+                            break
+                    if done:
+                        break
+                if done:
+                    break
+
+            # Points in cells beyond shell r are at least r * h away
+            reach = r * h
+            if cmin <= reach * reach:
+                done = True
+            r += 1
+
+        if cmin > cmax:
+            cmax = cmin
+    return np.sqrt(cmax)
+
+
+def getLabelHausdorff(testCoordinates, resultCoordinates, percentile=95):
+    """Compute the Hausdorff distance between the boundary points of one label, or None if either is empty."""
+    # hd_directed reads three coordinates per point without bounds checking
+    for coordinates in (testCoordinates, resultCoordinates):
+        if np.ndim(coordinates) != 2 or np.shape(coordinates)[1] != 3:
+            raise ValueError("Expected (N, 3) point coordinates, got shape " + str(np.shape(coordinates)))
+
+    # Hausdorff distance is only defined when something is detected
+    if len(testCoordinates) == 0 or len(resultCoordinates) == 0:
+        return None
+
+    # The maximum needs no full distance distribution, so use the early-terminating directed search.
+    # Visiting the points in random order makes the early break hit sooner than raster order.
+    # The kernel works in single precision, whose rounding is far below the voxel spacing, halving the memory it
+    # streams through. The kd-tree below works in float64 anyway, so the coordinates are only cast here.
+    if percentile >= 100:
+        rng = np.random.RandomState(0)
+        testCoordinates = np.ascontiguousarray(testCoordinates[rng.permutation(len(testCoordinates))], dtype=np.float32)
+        resultCoordinates = np.ascontiguousarray(resultCoordinates[rng.permutation(len(resultCoordinates))], dtype=np.float32)
+        return max(hd_directed(testCoordinates, resultCoordinates),
+                   hd_directed(resultCoordinates, testCoordinates))
+
+    # Compute distances from test to result and vice versa.
+    dTestToResult = getDistancesFromAtoB(testCoordinates, resultCoordinates)
+    dResultToTest = getDistancesFromAtoB(resultCoordinates, testCoordinates)
+    # np.percentile selects with a partial sort; the distance arrays are scratch, so let it partition in place
+    return max(np.percentile(dTestToResult, percentile, overwrite_input=True),
+               np.percentile(dResultToTest, percentile, overwrite_input=True))
+
+
+def getBoundaryCoordinates(labelArray, image):
+    """Return a dict with the world coordinates (in mm) of the boundary points of every label."""
+    indices, boundaryLabels = getBoundaries(labelArray)
+    counts = np.bincount(boundaryLabels, minlength=max(LABEL_KEYS) + 1)
+
+    coordinates = dict()
+    for k in LABEL_KEYS:
+        # Labels that are absent (frequently e.g. white matter lesions) need no selection or transform
+        if counts[k] == 0:
+            coordinates[k] = np.empty((0, 3), dtype=np.float64)
+        else:
+            coordinates[k] = getPhysicalPoints(image, indices[boundaryLabels == k])
+    return coordinates
+
+
+def getHausdorff(testCoordinates, resultCoordinates, percentile=95):
+    """Compute the 95% Hausdorff distance from the per-label boundary coordinates.
+
+    With percentile=100 the exact (maximum) Hausdorff distance is returned instead.
+    """
+    # The labels are independent and both the kd-tree queries and the Numba kernel release the GIL,
+    # so compute them on one thread per label
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(LABEL_KEYS)) as executor:
+        futures = dict()
+        for k in LABEL_KEYS:
+            # Hausdorff distance is only defined when something is detected; don't start a task otherwise
+            if len(testCoordinates[k]) > 0 and len(resultCoordinates[k]) > 0:
+                futures[k] = executor.submit(getLabelHausdorff, testCoordinates[k], resultCoordinates[k], percentile)
+
+        hd = dict((k, futures[k].result() if k in futures else None) for k in LABEL_KEYS)
 
     return hd
 
 
-def getVS(testImage, resultImage):
+def getVS(confusion):
     """Volume similarity.
     VS = 1 - abs(A - B) / (A + B)
     A = ground truth in ML
     B = participant segmentation in ML
     """
-    # Compute statistics of both images
-    testStatistics = sitk.StatisticsImageFilter()
-    resultStatistics = sitk.StatisticsImageFilter()
+    testSum = confusion.sum(axis=1).tolist()
+    resultSum = confusion.sum(axis=0).tolist()
 
     vs = dict()
-    for k in labels.keys():
-        testStatistics.Execute(sitk.BinaryThreshold(testImage, k, k, 1, 0))
-        resultStatistics.Execute(sitk.BinaryThreshold(resultImage, k, k, 1, 0))
-
-        numerator = abs(testStatistics.GetSum() - resultStatistics.GetSum())
-        denominator = testStatistics.GetSum() + resultStatistics.GetSum()
+    for k in LABEL_KEYS:
+        numerator = abs(testSum[k] - resultSum[k])
+        denominator = testSum[k] + resultSum[k]
 
         if denominator > 0:
             vs[k] = 1 - float(numerator) / denominator
@@ -159,53 +338,59 @@ def getVS(testImage, resultImage):
 
 def get_dice_score(lab2d, pred2d):
     """Compute the Dice Similarity Coefficient."""
+    confusion = getConfusionMatrix(lab2d, pred2d)
+    intersection = np.diagonal(confusion).tolist()
+    gt_sum = confusion.sum(axis=1).tolist()
+    pred_sum = confusion.sum(axis=0).tolist()
 
     dsc = dict()
     for k in range(9):
-        # similarity = 1.0 - dissimilarity
-        # scipy.spatial.distance.dice raises a ZeroDivisionError if both arrays contain only zeros.
-        try:
-            dsc[k] = 1.0 - scipy.spatial.distance.dice(np.where(lab2d==k,lab2d,0), np.where(pred2d==k,pred2d,0))
-        except ZeroDivisionError:
+        denominator = gt_sum[k] + pred_sum[k]
+        if denominator > 0:
+            dsc[k] = 2.0 * intersection[k] / denominator
+        else:
             print("DIvision by Zero")
             dsc[k] = 0
     return dsc
 
 def getDistancesFromAtoB(a, b):
-    kdTree = scipy.spatial.KDTree(a, leafsize=100)
+    """Return the distance from every point in b to its nearest neighbour in a.
+
+    Use the compiled kd-tree for fast spatial search: memory stays linear in the number of points,
+    unlike a dense len(a) x len(b) distance matrix, and the query releases the GIL.
+    """
+    kdTree = scipy.spatial.cKDTree(a, leafsize=100, balanced_tree=False)
     return kdTree.query(b, k=1, eps=0, p=2)[0]
 
 
 def get_hausdorff_distance(lab2d, pred2d):
     """Compute the Hausdorff Distance."""
 
+    # The callers pass flattened volumes; restore the 3D layout so the coordinates are (x, y, z) voxels
+    lab3d = np.reshape(lab2d, [220, 220, 48])
+    pred3d = np.reshape(pred2d, [220, 220, 48])
+
     h_dist = dict()
     for k in range(9):
-        gt_val = np.reshape(np.where(lab2d == k, lab2d, 0), [220, 220, 48])
-        pred_val = np.reshape(np.where(pred2d == k, pred2d, 0), [220, 220, 48])
-        # Compute distances from test to result and vice versa.
-        dTestToResult = getDistancesFromAtoB(gt_val, pred_val)
-        dResultToTest = getDistancesFromAtoB(pred_val, gt_val)
-        h_dist[k] = max(np.percentile(dTestToResult, 95), np.percentile(dResultToTest, 95))
-
-
-        # gt_val = np.reshape(np.where(lab2d==k,lab2d,0),[220,220,48])
-        # pred_val = np.reshape(np.where(pred2d==k,pred2d,0),[220,220,48])
-        # h_dist[k] = max(directed_hausdorff(u=gt_val, v=pred_val)[0],
-        #                     directed_hausdorff(u=pred_val, v=gt_val)[0])
+        # Voxel coordinates (N, 3) of the label, not the dense label mask
+        gt_coords = np.argwhere(lab3d == k).astype(np.float32)
+        pred_coords = np.argwhere(pred3d == k).astype(np.float32)
+
+        # Exact (maximum) distance in both directions with the early-terminating directed search
+        h_dist[k] = getLabelHausdorff(gt_coords, pred_coords, percentile=100)
     return h_dist
 
 
 def get_volumetric_symmetry(lab2d, pred2d):
     """Compute the volumetric symmetry"""
+    confusion = getConfusionMatrix(lab2d, pred2d)
+    gt_sum = confusion.sum(axis=1).tolist()
+    pred_sum = confusion.sum(axis=0).tolist()
 
     vs = dict()
     for k in range(9):
-        gt_labels = np.where(lab2d == k, lab2d, 0)
-        pred_labels = np.where(pred2d==k,pred2d,0)
-
-        numerator = abs(np.sum(gt_labels) - np.sum(pred_labels))
-        denominator = np.sum(gt_labels) + np.sum(pred_labels)
+        numerator = abs(gt_sum[k] - pred_sum[k])
+        denominator = gt_sum[k] + pred_sum[k]
 
         if denominator > 0:
             vs[k] = 1 - float(numerator) / denominator
@@ -93,38 +93,56 @@ def getImages(testFilename, resultFilename):
 
 def getDSC(testImage, resultImage):
     """Compute the Dice Similarity Coefficient."""
+    testArray = sitk.GetArrayViewFromImage(testImage).ravel().astype(np.intp)
+    resultArray = sitk.GetArrayViewFromImage(resultImage).ravel().astype(np.intp)
+
+    # Count the volume and overlap of every label at once instead of thresholding the images per label
+    numLabels = max(labels.keys()) + 1
+    testSum = np.bincount(testArray, minlength=numLabels).tolist()
+    resultSum = np.bincount(resultArray, minlength=numLabels).tolist()
+    intersection = np.bincount(testArray[testArray == resultArray], minlength=numLabels).tolist()
+
     dsc = dict()
     for k in labels.keys():
-        testArray = sitk.GetArrayFromImage(sitk.BinaryThreshold(testImage, k, k, 1, 0)).flatten()
-        resultArray = sitk.GetArrayFromImage(sitk.BinaryThreshold(resultImage, k, k, 1, 0)).flatten()
-
-        # similarity = 1.0 - dissimilarity
-        # scipy.spatial.distance.dice raises a ZeroDivisionError if both arrays contain only zeros.
-        try:
-            dsc[k] = 1.0 - scipy.spatial.distance.dice(testArray, resultArray)
-        except ZeroDivisionError:
+        # Dice is undefined if the label is absent from both images
+        denominator = testSum[k] + resultSum[k]
+        if denominator > 0:
+            dsc[k] = 2.0 * intersection[k] / denominator
+        else:
             dsc[k] = None
 
     return dsc
 
 
+def getPhysicalPoints(image, array):
+    """Return the world coordinates (in mm) of the nonzero voxels of a numpy (zyx) array as an (N, 3) array."""
+    # np.argwhere = elements in numpy order (zyx); reversing the columns gives (x,y,z) indices
+    # index -> world is origin + direction * diag(spacing) * index, i.e. what TransformIndexToPhysicalPoint does per voxel
+    direction = np.array(image.GetDirection(), dtype=np.float64).reshape(3, 3)
+    spacing = np.array(image.GetSpacing(), dtype=np.float64)
+    origin = np.array(image.GetOrigin(), dtype=np.float64)
+
+    indices = np.argwhere(array)[:, ::-1].astype(np.float64)
+    return indices.dot((direction * spacing).T) + origin
+
+
 def getHausdorff(testImage, resultImage):
     """Compute the 95% Hausdorff distance."""
+    # Count the voxels of every label once, so absent labels are skipped before any filtering
+    numLabels = max(labels.keys()) + 1
+    testSum = np.bincount(sitk.GetArrayViewFromImage(testImage).ravel().astype(np.intp), minlength=numLabels)
+    resultSum = np.bincount(sitk.GetArrayViewFromImage(resultImage).ravel().astype(np.intp), minlength=numLabels)
+
     hd = dict()
     for k in labels.keys():
-        lTestImage = sitk.BinaryThreshold(testImage, k, k, 1, 0)
-        lResultImage = sitk.BinaryThreshold(resultImage, k, k, 1, 0)
-
         # Hausdorff distance is only defined when something is detected
-        statistics = sitk.StatisticsImageFilter()
-        statistics.Execute(lTestImage)
-        lTestSum = statistics.GetSum()
-        statistics.Execute(lResultImage)
-        lResultSum = statistics.GetSum()
-        if lTestSum == 0 or lResultSum == 0:
+        if testSum[k] == 0 or resultSum[k] == 0:
             hd[k] = -1
             continue
 
+        lTestImage = sitk.BinaryThreshold(testImage, k, k, 1, 0)
+        lResultImage = sitk.BinaryThreshold(resultImage, k, k, 1, 0)
+
         # Edge detection is done by ORIGINAL - ERODED, keeping the outer boundaries of lesions. Erosion is performed in 2D
         eTestImage = sitk.BinaryErode(lTestImage, (1, 1, 0))
         eResultImage = sitk.BinaryErode(lResultImage, (1, 1, 0))
@@ -132,19 +150,12 @@ def getHausdorff(testImage, resultImage):
         hTestImage = sitk.Subtract(lTestImage, eTestImage)
         hResultImage = sitk.Subtract(lResultImage, eResultImage)
 
-        hTestArray = sitk.GetArrayFromImage(hTestImage)
-        hResultArray = sitk.GetArrayFromImage(hResultImage)
+        hTestArray = sitk.GetArrayViewFromImage(hTestImage)
+        hResultArray = sitk.GetArrayViewFromImage(hResultImage)
 
         # Convert voxel location to world coordinates. Use the coordinate system of the test image
-        # np.nonzero   = elements of the boundary in numpy order (zyx)
-        # np.flipud    = elements in xyz order
-        # np.transpose = create tuples (x,y,z)
-        # testImage.TransformIndexToPhysicalPoint converts (xyz) to world coordinates (in mm)
-        # (Simple)ITK does not accept all Numpy arrays; therefore we need to convert the coordinate tuples into a Python list before passing them to TransformIndexToPhysicalPoint().
-        testCoordinates = [testImage.TransformIndexToPhysicalPoint(x.tolist()) for x in
-                           np.transpose(np.flipud(np.nonzero(hTestArray)))]
-        resultCoordinates = [testImage.TransformIndexToPhysicalPoint(x.tolist()) for x in
-                             np.transpose(np.flipud(np.nonzero(hResultArray)))]
+        testCoordinates = getPhysicalPoints(testImage, hTestArray)
+        resultCoordinates = getPhysicalPoints(testImage, hResultArray)
 
         # Use a kd-tree for fast spatial search
         def getDistancesFromAtoB(a, b):
@@ -167,17 +178,15 @@ def getVS(testImage, resultImage):
     A = ground truth in ML
     B = participant segmentation in ML
     """
-    # Compute statistics of both images
-    testStatistics = sitk.StatisticsImageFilter()
-    resultStatistics = sitk.StatisticsImageFilter()
+    # Count the voxels of every label in a single pass over each image
+    numLabels = max(labels.keys()) + 1
+    testSum = np.bincount(sitk.GetArrayViewFromImage(testImage).ravel().astype(np.intp), minlength=numLabels).tolist()
+    resultSum = np.bincount(sitk.GetArrayViewFromImage(resultImage).ravel().astype(np.intp), minlength=numLabels).tolist()
 
     vs = dict()
     for k in labels.keys():
-        testStatistics.Execute(sitk.BinaryThreshold(testImage, k, k, 1, 0))
-        resultStatistics.Execute(sitk.BinaryThreshold(resultImage, k, k, 1, 0))
-
-        numerator = abs(testStatistics.GetSum() - resultStatistics.GetSum())
-        denominator = testStatistics.GetSum() + resultStatistics.GetSum()
+        numerator = abs(testSum[k] - resultSum[k])
+        denominator = testSum[k] + resultSum[k]
 
         if denominator > 0:
             vs[k] = 1 - float(numerator) / denominator